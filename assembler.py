@@ -3,25 +3,36 @@
     is to do in Python. Order of BRanch flags relaxed, BR without
     flags interpreted as BRnzv (allways).
 
-    With verbosity on prints source instructions without label
-    replacements (immediates and registers in place) to stdout.
+    Two passes: the first finds the labels and the pc of every
+    line, the second encodes with the label values known.
+
+    With verbosity on prints the encoded words with the source
+    lines to stdout.
 """
 
-from __future__ import print_function
 from array import array
+from itertools import product
 import os
+import re
 import sys
 
-try:
-    input = raw_input
-except:
-    pass
-
-reg_pos = [9, 6, 0]
+reg_pos = (9, 6, 0)
+comma_table = str.maketrans(',', ' ')
+mem_format = 'x{0:04X}: {1:016b} {1:04x} '.format
+label_match = re.compile(r'[A-Za-z][A-Za-z0-9_]*').fullmatch
+hex_match = re.compile(r'-?[0-9A-Fa-f]+').fullmatch
+escape_sub = re.compile(r'\\(.?)').sub
+# \l is line (form) feed
+escapes = {'n': '\n', 'r': '\r', 'b': '\b', 'l': '\f', 't': '\t', '0': '\0'}
 flags = {'n': 1 << 11, 'z': 1 << 10, 'p': 1 << 9}
-memory = array('H', [0] * (1 << 16))
-
-swap = True       # need to swap bytes
+# flag bits for BR suffixes in any order and case,
+# BR alone does not make sense so default to Branch always
+br_flags = {'': flags['n'] | flags['z'] | flags['p']}
+for n in range(1, 4):
+    for suffix in product('nzpNZP', repeat=n):
+        br_flags[''.join(suffix)] = sum(set(flags[f.lower()] for f in suffix))
+# address: word, only the used addresses
+memory = dict()
 
 instruction_info = dict((
     ('ADD', 0b1 << 12),
@@ -80,232 +91,305 @@ immediate = dict((
     ('UNDEFINED', 0)
     ))
 
-immediate_mask = dict()
-for im in immediate:
-    immediate_mask[im] = (1 << immediate[im]) - 1
+# tables above by mnemonic id, to avoid string lookups in encoding
+mnemonics = tuple(instruction_info)
+mnemonic_id = dict((m, i) for i, m in enumerate(mnemonics))
+base_enc = tuple(instruction_info[m] for m in mnemonics)
+imm_bits = tuple(immediate[m] for m in mnemonics)
+imm_mask = tuple((1 << b) - 1 for b in imm_bits)
 
-instructions = instruction_info.keys()
 
-
-regs = dict(('R%1i' % r, r) for r in range(8))
+regs = dict((sys.intern('R%1i' % r), r) for r in range(8))
+# register numbers shifted to their place: reg_at[operand number][register]
+reg_at = tuple(tuple(r << pos for r in range(8)) for pos in reg_pos)
 labels = dict()
-label_location = dict()
+# label: pcs using the label, for the cross reference
+references = dict()
+orig = pc = 0
 
 
 def put_and_show(n):
-    if n < 0: n = (1<<16) + n
-    memory[pc] = n
+    memory[pc] = n & 0xFFFF
     if verbose:
         print(get_mem_str(pc), end='')
 
 
 def get_mem_str(loc):
-    return 'x{0:04X}: {1:016b} {1:04x} '.format(loc, memory[loc])
+    return mem_format(loc, memory[loc])
 
 
 def reg(s, n=1):
-    return registers[s.rstrip(', ')] << reg_pos[n]
+    return reg_at[n][regs[s.rstrip(', ')]]
 
 
 def undefined(data):
     raise ValueError('Undefined Instruction')
 
 
+def use_label(label):
+    """ Value of label used at pc, None for undefined label """
+    refs = references.get(label)
+    if refs is None:
+        refs = references[label] = array('H')
+    refs.append(pc)
+    value = labels.get(label)
+    if value is None:
+        print('Bad label failure:')
+        print(label, ':', lc_hex(pc))
+    return value
+
+
 def valid_label(word):
-    if word[0] == 'x' and word[1].isdigit():
+    # x followed by digit is hex number, not label
+    if word[0] == 'x' and word[1:2].isdigit():
         return False
-    return (word[0].isalpha() and
-            all(c.isalpha() or c.isdigit() or c == '_' for c in word))
+    return label_match(word) is not None
 
 
 def get_immediate(word, mask=0xFFFF):
-    if (word.startswith('x') and
-        all(n in '-0123456789abcdefgABCDEF' for n in word[1:]) and
-        not '-' in word[2:]
-        ):
-        return int('0' + word, 0) & mask
-    elif word.startswith('#'):
-        return int(word[1:]) & mask
+    """ Value of x hex, # decimal or plain decimal word masked with
+        mask, None if word is not a number (e.g. label)
+    """
+    try:
+        if word[0] == 'x':
+            # int would also take _, + and 0x, those are labels or errors
+            if hex_match(word[1:]) is None:
+                return
+            return int(word[1:], 16) & mask
+        elif word[0] == '#':
+            return int(word[1:]) & mask
+        return int(word) & mask
+    except ValueError:
+        return
+
+
+def get_stringz(line):
+    """ Decode the quoted string of .STRINGZ line to array of
+        character codes (without the terminating zero)
+    """
+    string, quote, rest = line.partition('"')[2].partition('"')
+    # continue after escaped " inside quotes
+    while quote and string.endswith('\\'):
+        part, quote, rest = rest.partition('"')
+        string += '"' + part
+
+    # encode backslash to get special characters
+    return array('H', map(ord, escape_sub(unescape, string)))
+
+
+def unescape(match):
+    # easiest to implement:
+    # anything else escaped is itself (unlike Python)
+    c = match.group(1)
+    return escapes.get(c, c)
+
+
+def do_orig(words, line):
+    global orig, pc
+    word = words[words.index('.ORIG') + 1]
+    orig = pc = int('0' + word if word.startswith('x') else word, 0)
+    return '.ORIG', -1, 0, (), 0
+
+
+def do_fill(words, line):
+    ind = words.index('.FILL')
+    if ind:
+        labels[words[0]] = pc
+    return '.FILL', -1, 0, words[ind + 1:ind + 2], 1
+
+
+def do_stringz(words, line):
+    if valid_label(words[0]):
+        labels[words[0]] = pc
     else:
-        try:
-            return int(word) & mask
-        except ValueError:
-            return
+        print('Warning: no label for .STRINGZ in line for PC = x%04x:\n%s' % (pc, line))
+    codes = get_stringz(line)
+    return '.STRINGZ', -1, 0, codes, len(codes) + 1
 
 
-def process_instruction(words):
-    """ Process ready split words from line and parse the line
-        use put_and_show to show the instruction line without
-        label values
+def do_blkw(words, line):
+    if words[0] != '.BLKW':
+        labels[words[0]] = pc
+    value = get_immediate(words[-1])
+    if value is None or value <= 0:
+        raise ValueError('Bad .BLKW immediate: %s, %r' %
+                          (words[-1], value))
+    return '.BLKW', -1, 0, (value,), value
+
+
+# analysis of assembler directives, same return value as analyse_words
+directives = {
+    '.FILL': do_fill,
+    '.ORIG': do_orig,
+    '.STRINGZ': do_stringz,
+    '.BLKW': do_blkw,
+    }
+
+
+def analyse_words(words, line):
+    """ Find label, operation and operands from ready split words
+        of line, define the label at current pc.
+
+        Returns (found, fid, instruction, operands, size), found is
+        empty for lines without code, fid is the mnemonic id
+        (-1 for directives) and instruction is the encoding
+        without operands.
+    """
+    if not words:
+        return '', -1, 0, (), 0
+    for word in words[:2]:
+        directive = directives.get(word)
+        if directive:
+            return directive(words, line)
+
+    for ind, word in enumerate(words[:2]):
+        if word.startswith('BR'):
+            fl = br_flags.get(word[2:])
+            if fl is not None:
+                words[ind] = 'BR'
+                break
+
+    found = words[0]
+    fid = mnemonic_id.get(found, -1)
+    if fid < 0:
+        if valid_label(found):
+            labels[found] = pc
+        else:
+            print('Warning: invalid label %s in line\n%s' % (found, line))
+
+        if len(words) < 2:
+            return '', -1, 0, (), 0
+        found = words[1]
+        fid = mnemonic_id.get(found, -1)
+        if fid < 0:
+            input('Not instruction:%s' % line)
+            return '', -1, 0, (), 0
+
+    instruction = base_enc[fid]
+    if found == 'BR':
+        instruction |= fl
+    return found, fid, instruction, words[words.index(found) + 1:], 1
+
+
+def process_instruction(found, fid, instruction, operands, line):
+    """ Encode the analysed line at pc, use put_and_show to show
+        the encoded instruction
 
     """
-    global orig, pc
-    found = ''
-    if not words or words[0].startswith(';'):
+    global pc
+    if not found or found == '.ORIG':
         if verbose:
             print(3 * '\t', end='')
         return
-    elif '.FILL' in words:
-        word = words[words.index('.FILL') + 1]
-        try:
-            put_and_show(int(word))
-        except ValueError:
-            value = get_immediate(word)
-            if value is None:
-                if word in label_location:
-                    label_location[word].append([pc, 0xFFFF, 16])
-                else:
-                    label_location[word] = [[pc, 0xFFFF, 16]]
-            else:
-                memory[pc] = value
-
-        if words[0] != '.FILL':
-            labels[words[0]] = pc
+    elif found == '.FILL':
+        word = operands[0]
+        value = get_immediate(word)
+        if value is None:
+            # label address is absolute
+            value = use_label(word) or 0
+        put_and_show(value)
         pc += 1
-        return    
-    elif '.ORIG' in words:
-        orig = pc = int('0' + words[1]
-                        if words[1].startswith('x')
-                        else words[1], 0)
-        if verbose:
-            print(3 * '\t', end='')
         return
-    elif '.STRINGZ' in words:
-        if valid_label(words[0]):
-            labels[words[0]] = pc
-        else:
-            print('Warning: no label for .STRINGZ in line for PC = x%04x:\n%s' % (pc, line))
-        s = line.split('"')
-        string1 = string = s[1]
-        # rejoin if "  inside quotes
-        for st in s[2:]:
-            if string.endswith('\\'):
-                string += '"' + st
-
-        # encode backslash to get special characters
-        backslash = False
-        for c in string:
-            if not backslash:
-                if c == '\\':
-                    if not backslash:
-                        backslash = True
-                        continue
-                m = ord(c)
-            else:
-                if c in 'nblr':
-                    m = ord(c) - 100
-                else:
-                # easiest to implement:
-                # anything else escaped is itself (unlike Python)
-                    m = ord(c)
-
-                backslash = False
-
-            put_and_show(m)
-            if verbose:
+    elif found == '.STRINGZ':
+        if verbose:
+            for m in operands:
+                put_and_show(m)
                 print(repr(chr(m)))
-            pc += 1
+                pc += 1
+        else:
+            memory.update(zip(range(pc, pc + len(operands)), operands))
+            pc += len(operands)
         put_and_show(0)
         pc += 1
         return
-    elif '.BLKW' in words:
-        labels[words[0]] = pc
-        value = get_immediate(words[-1])
-        if value is None or value <= 0:
-            raise ValueError('Bad .BLKW immediate: %s, %r' %
-                              (words[-1], value))
-        pc += value
+    elif found == '.BLKW':
+        pc += operands[0]
         return
 
-    ind = -1
-    if words[0].startswith('BR'):
-        ind = 0
-    elif words[1:] and words[1].startswith('BR'):
-        ind = 1
-    if ind >= 0 and len(words[ind]) <= 5:
-        if all(c in flags for c in words[ind][2:].lower()):
-            fl = 0
-            # BR alone does not make sense so default to Branch always
-            if words[ind] == 'BR':
-                words[ind] = 'BRnzp'
-            for f in words[ind][2:].lower():
-                fl |= flags[f]
-            words[ind] = 'BR'
-
-    if words[0] in instructions:
-        found = words[0]
-    else:
-        if valid_label(words[0]):
-            labels[words[0]] = pc
+    # local names for the operand loop, register places are
+    # used in order (JMPT skips the first)
+    registers = regs
+    places = iter(reg_at[found == 'JMPT':])
+    op_mask, op_bits = imm_mask[fid], imm_bits[fid]
+
+    for word in operands:
+        if word in registers:
+            place = next(places, None)
+            if place is None:
+                raise ValueError('Too many registers: %r, line:\n%s\n' %
+                                 (word, line))
+            instruction |= place[registers[word]]
         else:
-            print('Warning: invalid label %s in line\n%s' % (words[0], line))
-
-        if len(words) < 2:
-            return
-        found = words[1] if words[1] in instructions else ''
-
-    if not found:
-        word = words[0]
-        if len(words) > 1:
-            input('Not instruction:%s' % line)
-            return
-        else:
-            if valid_label(word):
-                if word in label_location:
-                    label_location[word].append([pc, 0xFFFF, 16])
-                else:
-                    label_location[word] = [[pc, 0xFFFF, 16]]
+            value = get_immediate(word, op_mask)
+            if value is not None:
+                instruction |= value
+                if found in ('ADD', 'AND'):
+                    instruction |= 1 << 5
+            elif valid_label(word):
+                target = use_label(word)
+                if target is not None:
+                    offset = target - pc - 1
+                    high = 1 << (op_bits - 1)
+                    if not -high <= offset < high:
+                        raise ValueError(("%s, mask %s, offset %s,  %s, ref %s" %
+                                (word,
+                                bin(op_mask),
+                                target - pc,
+                                bin(target),
+                                hex(pc))))
+                    instruction |= offset & op_mask
             else:
                 raise ValueError('Invalid label: %r, line:\n%s\n' %
-                                    (word, line))
-        return
+                                 (word, line))
 
-    try:
-        instruction = instruction_info[found]
-    except KeyError:
-        input('Unknown: %s' % found)
-    else:
-        if found == 'BR':
-            instruction |= fl
-        r = rc = 0
-        rc += found == 'JMPT'
-    
-        for word in words[1:]:
-            word = word.rstrip(',')
-            if word in regs:
-                t = regs[word] << reg_pos[rc]
-                r |= t
-                rc += 1
-            else:
-                value = get_immediate(word, immediate_mask[found])
-                if value is not None:
-                    instruction |= value
-                    if found in ('ADD', 'AND'):
-                        instruction |= 1 << 5
-                elif word != found:
-                    if valid_label(word):
-                        if word in label_location:
-                            label_location[word].append([pc, immediate_mask[found], immediate[found]])
-                        else:
-                            label_location[word] = [[pc, immediate_mask[found], immediate[found]]]
-                    else:
-                        raise ValueError('Invalid label: %r, line:\n%s\n' %
-                                     (word, line))
-
-            instruction |= r
-            if found == 'JMPT':
-                break
+        if found == 'JMPT':
+            break
+
+    put_and_show(instruction)
+    pc += 1
+
+
+def analysis_pass(lines):
+    """ First pass: split each line once, define labels and find
+        the pc of every line up to .END
+
+        Returns list of (pc, found, fid, instruction, operands, line)
+    """
+    global pc
+    tokens = []
+    for line in lines:
+        # drop comments, make sure registers are space separated
+        # also (not with strings)
+        code = line.partition(';')[0]
+        if ',' in code and '"' not in code:
+            code = code.translate(comma_table)
+        # interned words make dict lookups of mnemonics, registers
+        # and labels mostly pointer compares
+        words = [sys.intern(w) for w in code.split()]
+        if '.END' in words:
+            break
+        found, fid, instruction, operands, size = analyse_words(words, line)
+        tokens.append((pc, found, fid, instruction, operands, line))
+        pc += size
+    return tokens
+
+
+def synthesis_pass(tokens):
+    """ Second pass: encode the lines analysed by analysis_pass
+        to memory, labels are all known from the first pass
+    """
+    global pc
+    for pc, found, fid, instruction, operands, line in tokens:
+        process_instruction(found, fid, instruction, operands, line)
+        if verbose:
+            # show binary form in verbose mode
+            print('\t', line)
 
-        put_and_show(instruction)
-        pc += 1
 
 def lc_hex(h):
     """ lc hex has not the first 0 """
     return hex(h)[1:]
 
-def in_range(n, bits):
-    return -(1<< (bits-1)) <=  n < (1<< (bits-1))
-   
 if __name__ == '__main__':
 
     code = r'''
@@ -349,86 +433,45 @@ if __name__ == '__main__':
     verbose = input('Verbose Y/n? ').lower() != 'n'
 
     # processing the lines
-    for line in code.splitlines():
-        # remove comments
-        orig_line, line = line, line.split(';')[0]
-        # add space after comma to make sure registers are space separated also (not with strings)
-        if '"' not in line:
-            line = line.replace(',', ', ')
-        # drop comments
-        words = (line.split()) if ';' in line else line.split()
-        if '.END' in words:
-                break
-        process_instruction(words)
-        if verbose:
-            # show binary form without label values in verbose mode
-            print('\t', orig_line)
+    synthesis_pass(analysis_pass(code.splitlines()))
 
     # producing output
-    for label, value in label_location.items():
-        if label not in labels:
-            print('Bad label failure:')
-            print(label, ':', label_location[label])
-        else:
-            for ref, mask, bits in value:
-                current = labels[label] - ref - 1
-                # gludge for absolute addresses,
-                # but seems correct for some code (lc3os.asm)
-                if memory[ref] == 0: # not instruction -> absolute
-                    memory[ref] = labels[label]
-                elif not in_range(current,bits) :
-                    raise ValueError(("%s, mask %s, offset %s,  %s, ref %s" %
-                            (label,
-                            bin(mask),
-                            labels[label] - ref,
-                            bin(labels[label]),
-                            hex(ref))))
-                else:
-                    memory[ref] |= mask & current
-
     # choose base different from standard utilities to enable comparison
 
     # symbol list for Simulators
     with open(base + '.sym', 'w') as f:
-        print('''//Symbol Name		Page Address
+        f.write('''//Symbol Name		Page Address
 //----------------	------------
-//''', end='\t', file=f)
-
-        print('\n//\t'.join('\t%-20s%4x' % (name, value)
-                        for name, value in labels.items()), file=f)
+//\t''' + '\n//\t'.join(['\t%-20s%4x' % item for item in labels.items()])
+                + '\n')
 
     print(80 * '-', '\n')
     print('Symbol cross reference:'.center(60) +
             '\n\n\t%-20s%-10s%s' % ('NAME', 'PLACE', 'USED'),
             end='\n' + 80 * '-' + '\n\t')
     # some cutting required to drop 0 from hex numbers
-    print('\n\n\t'.join('%-20s%-10s%s' %
-           (key, lc_hex(item),
-            ', '.join(map(lc_hex, (list(zip(*label_location[key]))[0]
-                        if key in label_location else ''))))
+    used = dict((key, ', '.join(map(lc_hex, refs)))
+                for key, refs in references.items())
+    print('\n\n\t'.join(['%-20s%-10s%s' % (key, lc_hex(item), used.get(key, ''))
           # sort case insensitively by key
-          for key, item in sorted(labels.items(), key=lambda x: x[0].lower())))
+          for key, item in sorted(labels.items(), key=lambda x: x[0].lower())]))
+
+    # orig address first, then the program (.BLKW space is 0)
+    words = array('H', [orig])
+    words.extend(memory.get(m, 0) for m in range(orig, pc))
 
     # binary numbers output
     print('\n.bin file saved as ', end='')
 
     with open(base + '.bin', 'w') as f:
         print(f.name)
-        print('{0:016b}'.format(orig), file=f)  # orig address
-        print('\n'.join('{0:016b}'.format(memory[m]) for m in range(orig, pc)),
-                file=f)
+        fmt = format
+        f.write('\n'.join([fmt(w, '016b') for w in words]) + '\n')
 
     # object file for running in Simulator
     with open(base + '.obj', 'wb') as f:
         print('.obj file saved as', f.name)
-        #do slice from right after code and write
-        #(byteorder of 0 does not matter)
-        memory[pc] = orig
-        if swap:
-            memory.byteswap()
-
-        memory[pc:pc+1].tofile(f)
-        memory[orig:pc].tofile(f)
-        # better to restore swap for future, even program stops here
-        if swap:
-            memory.byteswap()
\ No newline at end of file
+        # big endian
+        if sys.byteorder == 'little':
+            words.byteswap()
+        words.tofile(f)